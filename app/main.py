@@ -2,17 +2,29 @@
 import os, boto3, json
 from shared.teams import post_to_teams, simple_card
 from compute.handler import run as run_compute
+from shared.collectors import get_acct_title
+
+# Built once per container; reused by warm invocations
+_region  = os.environ.get("AWS_REGION","us-east-1")
+_session = boto3.Session(region_name=_region)
+try:
+    _webhook = os.environ["TEAMS_WEBHOOK"]
+except KeyError:
+    _webhook = None  # re-read (and required) at invoke time
 
 def lambda_handler(event, context):
-    env = {k: os.environ.get(k,"") for k in os.environ.keys()}
-    region  = os.environ.get("AWS_REGION","us-east-1")
-    webhook = os.environ["TEAMS_WEBHOOK"]
-    session = boto3.Session(region_name=region)
+    env = os.environ.copy()  # one snapshot per invocation
+    region  = _region
+    webhook = _webhook or os.environ["TEAMS_WEBHOOK"]
+    session = _session
+
+    # Prime the account label from the function ARN so compute can skip sts:GetCallerIdentity
+    get_acct_title(session, getattr(context, "invoked_function_arn", None))
 
     results = {}
   
-    enable_compute = os.environ.get("ENABLE_COMPUTE","true").lower() in ("1","true","t","yes","y")
+    enable_compute = env.get("ENABLE_COMPUTE","true").lower() in ("1","true","t","yes","y")
     if enable_compute:
         results["compute"] = run_compute(session, webhook, region, env)
 
-    return {"ok": True, "modules": results}
+    return {"ok": all(r.get("ok") for r in results.values()), "modules": results}
@@ -1,12 +1,37 @@
 # ec2_compute/handler.py
-import os, re, boto3, math, logging
+import re, json, time, boto3, math, heapq, logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
+from itertools import groupby
 from shared.teams import post_to_teams, simple_card
+from shared.aws import BOTO_CFG
 from shared.collectors import get_acct_title
 
 # ---------------- logging ----------------
 logger = logging.getLogger(__name__)
 
+# ---------------- warm-container caches ----------------
+# Module scope survives across invocations of the same Lambda container.
+DIMS_CACHE_TTL = 3600  # seconds
+DIMS_NEG_TTL   = 300   # seconds; empty sweeps are retried sooner, and misses may force a re-sweep this often
+_DIMS_CACHE = {}       # (cloudwatch client, metric_name) -> (fetched_at, {instance_id: [dims, ...]})
+_DIMS_MISS = {}        # (cloudwatch client, metric_name, instance_id) -> when a fresh sweep confirmed no dims
+_DIMS_RESWEEP_AT = {}  # (cloudwatch client, metric_name) -> last forced re-sweep attempt
+_CLIENTS = {}          # (session, service, region) -> boto3 client
+MAX_METRIC_QUERIES = 500  # GetMetricData limit per call
+_CWAGENT_METRICS = (("mem", "mem_used_percent"), ("dsk", "disk_used_percent"))
+
+def _client(session, name, region):
+    # Client construction (endpoint resolution, credential chain) is slow; build once per container.
+    # Keyed on the session object itself (a strong reference, so its identity can't be recycled):
+    # a different session, i.e. other credentials, never gets another session's client.
+    key = (session, name, region)
+    c = _CLIENTS.get(key)
+    if c is None:
+        c = _CLIENTS[key] = session.client(name, region_name=region, config=BOTO_CFG)
+    return c
+
 # ---------------- UI helpers ----------------
 def _cell(text, *, bold=False, color=None, width="auto", wrap=False):
     block = {"type":"TextBlock","text":str(text),"wrap":bool(wrap),
@@ -15,109 +40,147 @@ def _cell(text, *, bold=False, color=None, width="auto", wrap=False):
     if color: block["color"]=color
     return {"type":"Column","width":width,"items":[block]}
 
-def _color_for(pct, warn, alert):
-    if pct is None: return None
-    try: v = float(pct)
-    except Exception: return None
-    if v >= alert: return "attention"
-    if v >= warn:  return "warning"
-    return "good"
-
-def _emoji_for(pct, warn, alert):
-    if pct is None: return ""
-    try: v = float(pct)
-    except Exception: return ""
-    if v >= alert: return "🔴"
-    if v >= warn:  return "🟡"
-    return "🟢"
-
-def _fmt_pct(v):
-    return "N/A" if v is None else f"{float(v):.0f}%"
+# metric level -> (card color, emoji); None = metric missing
+_LEVEL_STYLE = {"OK": ("good", "🟢"), "WARN": ("warning", "🟡"), "ALERT": ("attention", "🔴"), None: (None, "")}
 
 # ---------------- CloudWatch/EC2 helpers ----------------
-def _get_instances(ec2, tag_key=None, tag_val=None, only_running=True, max_instances=200):
+def _has_tag(inst, key, val=None):
+    return any(t.get("Key")==key and (val is None or t.get("Value")==val) for t in inst.get("Tags", []))
+
+def _get_instances(ec2, tag_key=None, tag_val=None, only_running=True, max_instances=200, agent_tag=None):
+    # Generator: yields (instance_id, name, has_agent) page by page so callers can start work
+    # before paging finishes; the rest of each Instance dict is dropped right away.
+    # has_agent is True unless agent_tag=(key, value|None) is given and the instance lacks it.
+    # Pages are sized to the cap, so fleets up to 1000 instances take a single call.
     filters=[{"Name":"instance-state-name","Values":["running"]}] if only_running else []
     if tag_key and tag_val:
         filters.append({"Name": f"tag:{tag_key}", "Values": [tag_val]})
-    res=[]
+    kwargs = {"Filters": filters, "MaxResults": min(max(max_instances, 5), 1000)}  # API allows 5..1000
+    count=0
     try:
-        paginator = ec2.get_paginator("describe_instances")
-        for page in paginator.paginate(Filters=filters) if filters else paginator.paginate():
+        while True:
+            page = ec2.describe_instances(**kwargs)
             for r in page.get("Reservations", []):
                 for i in r.get("Instances", []):
-                    res.append(i)
-                    if len(res) >= max_instances:
-                        return res
+                    name = next((t["Value"] for t in i.get("Tags",[]) if t.get("Key")=="Name"), "")
+                    yield i["InstanceId"], name, (agent_tag is None or _has_tag(i, *agent_tag))
+                    count += 1
+                    if count >= max_instances:
+                        return
+            token = page.get("NextToken")
+            if not token: return
+            kwargs["NextToken"] = token
     except Exception:
         pass
-    return res
 
-def _latest_stat_cw(cw, namespace, metric_name, dims, minutes=15, period=300, stat="Average", *, start=None, end=None):
-    try:
-        end = end or datetime.now(timezone.utc)
-        start = start or (end - timedelta(minutes=minutes))
-        dps = cw.get_metric_statistics(
-            Namespace=namespace, MetricName=metric_name, Dimensions=dims,
-            StartTime=start, EndTime=end, Period=period, Statistics=[stat]
-        ).get("Datapoints", [])
-        if not dps: return None
-        latest = max(dps, key=lambda x: x["Timestamp"])
-        return latest.get(stat)
-    except Exception:
-        return None
+def _metric_query(qid, namespace, metric_name, dims, period, stat="Average"):
+    return {"Id": qid, "ReturnData": True,
+            "MetricStat": {"Metric": {"Namespace": namespace, "MetricName": metric_name, "Dimensions": dims},
+                           "Period": period, "Stat": stat}}
 
-def _series_stat_cw(cw, namespace, metric_name, dims, *, start, end, period, stat="Average"):
+def _get_metric_batch(cw, queries, *, start, end):
+    """
+    One GetMetricData batch (at most MAX_METRIC_QUERIES queries), following NextToken.
+    Returns {query_id: [(ts, value), ...]} newest first.
+    """
+    out = {}
+    kwargs = {"MetricDataQueries": queries, "StartTime": start, "EndTime": end,
+              "ScanBy": "TimestampDescending"}
     try:
-        dps = cw.get_metric_statistics(
-            Namespace=namespace, MetricName=metric_name, Dimensions=dims,
-            StartTime=start, EndTime=end, Period=period, Statistics=[stat]
-        ).get("Datapoints", [])
-        dps.sort(key=lambda x: x["Timestamp"])  # ascending
-        out=[]
-        for dp in dps:
-            ts = dp["Timestamp"]
-            if ts.tzinfo is None:
-                ts = ts.replace(tzinfo=timezone.utc)
-            else:
-                ts = ts.astimezone(timezone.utc)
-            out.append((ts, dp.get(stat)))
-        return out
-    except Exception:
-        return []
+        while True:
+            resp = cw.get_metric_data(**kwargs)
+            for r in resp.get("MetricDataResults", []):
+                out.setdefault(r["Id"], []).extend(zip(r.get("Timestamps", []), r.get("Values", [])))
+            token = resp.get("NextToken")
+            if not token: break
+            kwargs["NextToken"] = token
+    except Exception as e:
+        logger.warning("GetMetricData failed for %d queries: %s", len(queries), e)
+    return out
 
-def _find_cwagent_metric_dims(cw, metric_name, instance_id, max_scan=25):
+def _all_cwagent_dims(cw, metric_name, max_scan=25, ttl=DIMS_CACHE_TTL):
+    """
+    One ListMetrics sweep for `metric_name` across the whole fleet.
+    Returns {instance_id: [dims, ...]} (at most `max_scan` dim sets per instance).
+    CWAgent dim sets barely change hour to hour, so results are reused across warm invocations;
+    an empty sweep (no agents yet) is only kept for DIMS_NEG_TTL. A failed sweep is never cached:
+    the previous map (if any) stays in place and is returned.
+    """
+    now = time.time()
+    key = (cw, metric_name)  # the client pins session + region
+    hit = _DIMS_CACHE.get(key)
+    if hit and now - hit[0] < (ttl if hit[1] else min(ttl, DIMS_NEG_TTL)):
+        return hit[1]
+    by_iid = {}
     try:
         paginator = cw.get_paginator("list_metrics")
-        dims = []; count = 0
         for page in paginator.paginate(Namespace="CWAgent", MetricName=metric_name, Dimensions=[{"Name":"InstanceId"}]):
             for m in page.get("Metrics", []):
-                if any(d.get("Name")=="InstanceId" and d.get("Value")==instance_id for d in m.get("Dimensions", [])):
-                    dims.append(m.get("Dimensions", [])); count += 1
-                    if count >= max_scan: return dims
-        return dims
-    except Exception:
-        return []
-
-def _series_max_cwagent(cw, metric_name, dims_list, *, start, end, period):
-    buckets = {}
-    for dims in dims_list or []:
-        series = _series_stat_cw(cw, "CWAgent", metric_name, dims, start=start, end=end, period=period, stat="Average")
-        for ts, val in series:
-            if val is None:
-                continue
-            k = ts.replace(microsecond=0)
-            buckets[k] = max(buckets.get(k, float("-inf")), float(val))
-    out = [(ts, v) for ts, v in sorted(buckets.items()) if v != float("-inf")]
-    return out
-
-def _max_across_dims(cw, metric_name, dims_list, minutes=15, period=300, *, start=None, end=None):
+                dims = m.get("Dimensions", [])
+                iid = next((d.get("Value") for d in dims if d.get("Name")=="InstanceId"), None)
+                if not iid: continue
+                found = by_iid.setdefault(iid, [])
+                if len(found) < max_scan:
+                    found.append(dims)
+    except Exception as e:
+        logger.warning("ListMetrics sweep for %s failed: %s", metric_name, e)
+        return hit[1] if hit else {}  # keep the last good map; retried next call
+    _DIMS_CACHE[key] = (now, by_iid)
+    # Confirmations older than a full TTL belong to instances no longer being checked (terminated)
+    for mk in list(_DIMS_MISS):
+        if mk[:2] == key and _DIMS_MISS.get(mk, now) < now - DIMS_CACHE_TTL:
+            _DIMS_MISS.pop(mk, None)
+    return by_iid
+
+def _cwagent_dims(cw, metric_name, instance_id, expected=False):
+    """
+    Cache-only lookup (run() refreshes the sweeps up front, so a failed sweep isn't retried per instance).
+    Returns (dims, stale): stale is True when a miss suggests the cached sweep predates the instance's
+    agent -- the miss was never confirmed by a fresh sweep (e.g. a new instance), or the instance is
+    tagged as running the agent (`expected`). Confirmed agent-less instances stop counting.
+    """
+    hit = _DIMS_CACHE.get((cw, metric_name))
+    if not hit:
+        return [], False
+    miss_key = (cw, metric_name, instance_id)
+    dims = hit[1].get(instance_id)
+    if dims is not None:
+        _DIMS_MISS.pop(miss_key, None)
+        return dims, False
+    now = time.time()
+    if now - hit[0] < DIMS_NEG_TTL:
+        _DIMS_MISS[miss_key] = now  # a fresh sweep doesn't have it: no agent (for now)
+        return [], False
+    return [], expected or miss_key not in _DIMS_MISS
+
+def _claim_resweep(cw, metric_name):
+    # At most one forced re-sweep per metric per DIMS_NEG_TTL, successful or not
+    key = (cw, metric_name)
+    now = time.time()
+    last = max(_DIMS_RESWEEP_AT.get(key, 0), _DIMS_CACHE.get(key, (0,))[0])
+    if now - last < DIMS_NEG_TTL:
+        return False
+    _DIMS_RESWEEP_AT[key] = now
+    return True
+
+def _latest_across(series_list):
+    # series are newest first; take the latest point of each dim set, then the max
     best = None
-    for dims in dims_list:
-        val = _latest_stat_cw(cw, "CWAgent", metric_name, dims, minutes=minutes, period=period, stat="Average", start=start, end=end)
-        if val is None: continue
+    for series in series_list:
+        if not series: continue
+        val = series[0][1]
         best = val if best is None else max(best, val)
     return best
 
+def _series_max_across(series_list):
+    # Series arrive newest first on the period grid: merge them lazily and take the max per
+    # timestamp (no bucket dict or re-sort). Returns [(ts_utc, value), ...] oldest first.
+    merged = heapq.merge(*series_list, key=lambda p: p[0], reverse=True)
+    out = [(ts.astimezone(timezone.utc), max(v for _, v in grp))
+           for ts, grp in groupby(merged, key=lambda p: p[0])]
+    out.reverse()
+    return out
+
 def _ec2_console_link(region, instance_id):
     return f"https://{region}.console.aws.amazon.com/ec2/home?region={region}#InstanceDetails:instanceId={instance_id}"
 
@@ -132,60 +195,83 @@ def _metric_level(v, warn, alert):
     if v >= warn:  return "WARN"
     return "OK"
 
-def _row_overall_level(cpu, mem, dsk, th):
-    levels = [
-        _metric_level(cpu, th["CPU_WARN"],  th["CPU_ALERT"]),
-        _metric_level(mem, th["MEM_WARN"],  th["MEM_ALERT"]),
-        _metric_level(dsk, th["DISK_WARN"], th["DISK_ALERT"]),
-    ]
+def _row_overall_level(levels):
+    levels = list(levels)
     if "ALERT" in levels: return "ALERT"
     if "WARN"  in levels: return "WARN"
     return "OK"
 
+# ---------------- Report rows ----------------
+@dataclass(slots=True)
+class Row:
+    iid:  str
+    name: str
+    cpu:  float | None
+    mem:  float | None
+    dsk:  float | None
+
+def _limits(th):
+    return ((th["CPU_WARN"], th["CPU_ALERT"]), (th["MEM_WARN"], th["MEM_ALERT"]), (th["DISK_WARN"], th["DISK_ALERT"]))
+
+def _metric_cell(v, warn, alert):
+    if v is None:
+        color, emoji = _LEVEL_STYLE[None]
+        return "OK", "N/A", emoji, color  # missing metric shouldn't trigger
+    level = _metric_level(v, warn, alert)
+    color, emoji = _LEVEL_STYLE[level]
+    return level, f"{v:.0f}%", emoji, color
+
+def _row_cells(row, limits):
+    # ((level, pct, emoji, color) for cpu/mem/dsk); computed once per row in run() and
+    # handed to the offender filter and the card/email builders as (row, cells) pairs
+    return tuple(_metric_cell(v, w, a) for v, (w, a) in zip((row.cpu, row.mem, row.dsk), limits))
+
 # ---------------- Card builder ----------------
-def _build_cards(account_label, rows, rows_per_card):
+# Invariant card scaffolding, built once and shared (read-only) by every card
+_CARD_HEADERS = ["Instance-ID / Name", "CPU", "Mem", "Disk"]
+_CARD_WIDTHS  = [str(w) for w in (8, 2, 2, 2)]
+_CARD_HEADER_COLUMNS = [_cell(h, bold=True, width=w) for h, w in zip(_CARD_HEADERS, _CARD_WIDTHS)]
+_CARD_SCHEMA = {"$schema":"http://adaptivecards.io/schemas/adaptive-card.json",
+                "type":"AdaptiveCard","version":"1.4"}
+
+def _build_cards(account_label, rows, rows_per_card, *, region):
+    # rows: [(Row, cells), ...] with cells from _row_cells
     if not rows:
         return [simple_card(f"{account_label} - Compute (CPU/Mem/Disk)", "No WARN/ALERT instances.")]
-    headers = ["Instance-ID / Name", "CPU", "Mem", "Disk"]
-    widths  = [8, 2, 2, 2]
+    widths  = _CARD_WIDTHS
+    title   = f"{account_label} - Compute (CPU/Mem/Disk) - ⚠️ Offenders"
     cards=[]
     for i in range(0, len(rows), rows_per_card):
         chunk = rows[i:i+rows_per_card]
         body = [
-            {"type":"TextBlock","text":f"{account_label} - Compute (CPU/Mem/Disk) - ⚠️ Offenders","weight":"Bolder","size":"Medium"},
-            {"type":"ColumnSet","separator":True,"spacing":"Medium",
-             "columns":[_cell(h, bold=True, width=str(widths[j])) for j,h in enumerate(headers)]}
+            {"type":"TextBlock","text":title,"weight":"Bolder","size":"Medium"},
+            {"type":"ColumnSet","separator":True,"spacing":"Medium","columns":_CARD_HEADER_COLUMNS}
         ]
-        for iid, name, cpu, mem, disk, th, region in chunk:
-            link = _ec2_console_link(region, iid)
-            id_cell = f"[{iid}]({link})" + (f"\n{name}" if name else "")
-            cpu_cell = f"{_emoji_for(cpu, th['CPU_WARN'], th['CPU_ALERT'])} {_fmt_pct(cpu)}"
-            mem_cell = f"{_emoji_for(mem, th['MEM_WARN'], th['MEM_ALERT'])} {_fmt_pct(mem)}"
-            dsk_cell = f"{_emoji_for(disk, th['DISK_WARN'], th['DISK_ALERT'])} {_fmt_pct(disk)}"
+        for row, cells in chunk:
+            link = _ec2_console_link(region, row.iid)
+            id_cell = f"[{row.iid}]({link})" + (f"\n{row.name}" if row.name else "")
+            metric_cells = [_cell(f"{emoji} {pct}", width=widths[j], color=color)
+                            for j, (_, pct, emoji, color) in enumerate(cells, start=1)]
             body.append({"type":"ColumnSet","columns":[
-                _cell(id_cell, width=str(widths[0]), wrap=True),
-                _cell(cpu_cell, width=str(widths[1]), color=_color_for(cpu, th['CPU_WARN'], th['CPU_ALERT'])),
-                _cell(mem_cell, width=str(widths[2]), color=_color_for(mem, th['MEM_WARN'], th['MEM_ALERT'])),
-                _cell(dsk_cell, width=str(widths[3]), color=_color_for(disk, th['DISK_WARN'], th['DISK_ALERT'])),
+                _cell(id_cell, width=widths[0], wrap=True),
+                *metric_cells,
             ]})
         cards.append({
             "type":"message",
             "attachments":[{"contentType":"application/vnd.microsoft.card.adaptive",
-                            "content":{"$schema":"http://adaptivecards.io/schemas/adaptive-card.json",
-                                       "type":"AdaptiveCard","version":"1.4","body":body}}]
+                            "content":{**_CARD_SCHEMA, "body":body}}]
         })
     return cards
 
 # ---------------- Email build/send ----------------
-def _build_email(acct, rows):
-    def row_html(r):
-        iid, name, cpu, mem, dsk, th, region = r
-        link = _ec2_console_link(region, iid)
-        cpu_s = f"{_emoji_for(cpu, th['CPU_WARN'], th['CPU_ALERT'])} {_fmt_pct(cpu)}"
-        mem_s = f"{_emoji_for(mem, th['MEM_WARN'], th['MEM_ALERT'])} {_fmt_pct(mem)}"
-        dsk_s = f"{_emoji_for(dsk, th['DISK_WARN'], th['DISK_ALERT'])} {_fmt_pct(dsk)}"
-        name_html = f"<br/><span style='color:#555'>{name}</span>" if name else ""
-        return f"<tr><td><a href='{link}'>{iid}</a>{name_html}</td><td style='text-align:right'>{cpu_s}</td><td style='text-align:right'>{mem_s}</td><td style='text-align:right'>{dsk_s}</td></tr>"
+def _build_email(acct, rows, *, region):
+    # rows: [(Row, cells), ...] with cells from _row_cells
+    def row_html(item):
+        r, cells = item
+        link = _ec2_console_link(region, r.iid)
+        cpu_s, mem_s, dsk_s = (f"{emoji} {pct}" for _, pct, emoji, _ in cells)
+        name_html = f"<br/><span style='color:#555'>{r.name}</span>" if r.name else ""
+        return f"<tr><td><a href='{link}'>{r.iid}</a>{name_html}</td><td style='text-align:right'>{cpu_s}</td><td style='text-align:right'>{mem_s}</td><td style='text-align:right'>{dsk_s}</td></tr>"
 
     title = f"{acct} - EC2 Utilization Alerts (CPU/Mem/Disk)"
     if not rows:
@@ -210,14 +296,17 @@ def _build_email(acct, rows):
     <p style="color:#777">Tip: Install CloudWatch Agent to populate Mem/Disk metrics.</p>
     </body></html>"""
 
-    def row_text(r):
-        iid, name, cpu, mem, dsk, th, region = r
-        link = _ec2_console_link(region, iid)
-        name_s = f" {name}" if name else ""
-        return f"{iid}{name_s}\n  CPU={_fmt_pct(cpu)}  MEM={_fmt_pct(mem)}  DISK={_fmt_pct(dsk)}\n  {link}\n"
+    def row_text(item):
+        r, cells = item
+        link = _ec2_console_link(region, r.iid)
+        name_s = f" {r.name}" if r.name else ""
+        cpu_s, mem_s, dsk_s = (pct for _, pct, _, _ in cells)
+        return f"{r.iid}{name_s}\n  CPU={cpu_s}  MEM={mem_s}  DISK={dsk_s}\n  {link}\n"
     text = f"{title}\n\n" + "\n".join(row_text(r) for r in rows)
     return text, html
 
+_EMAIL_SPLIT_RE = re.compile(r'[,\s;]+')
+
 def _parse_email_list(raw: str):
     """
     Accepts comma/semicolon/space/newline separated addresses, e.g.:
@@ -225,7 +314,7 @@ def _parse_email_list(raw: str):
     Returns a de-duplicated list preserving order.
     """
     if not raw: return []
-    parts = re.split(r'[,\s;]+', raw.strip())
+    parts = _EMAIL_SPLIT_RE.split(raw.strip())
     parts = [p for p in parts if p]
     seen = set(); out = []
     for p in parts:
@@ -244,7 +333,7 @@ def _send_email_ses(session, region, subject, text_body, html_body, env):
     bcc_list  = _parse_email_list(env.get("MAIL_BCC",""))
     if not mail_from or not to_list:
         return None
-    ses = session.client("ses", region_name=region)
+    ses = _client(session, "ses", region)
     dest = {"ToAddresses": to_list}
     if cc_list:  dest["CcAddresses"]  = cc_list
     if bcc_list: dest["BccAddresses"] = bcc_list
@@ -260,13 +349,38 @@ def _send_email_ses(session, region, subject, text_body, html_body, env):
         },
     )
 
+# ---------------- Run metrics (CloudWatch Embedded Metric Format) ----------------
+EMF_NAMESPACE = "EC2Util"
+
+def _emit_emf(acct, offenders, scanned, collect_ms):
+    # One structured stdout line; Lambda ships it to CloudWatch Logs, which extracts the
+    # metrics asynchronously -- no PutMetricData call on the hot path.
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": EMF_NAMESPACE,
+                "Dimensions": [["Account"]],
+                "Metrics": [
+                    {"Name": "Offenders",        "Unit": "Count"},
+                    {"Name": "InstancesScanned", "Unit": "Count"},
+                    {"Name": "CollectMs",        "Unit": "Milliseconds"},
+                ],
+            }],
+        },
+        "Account": acct,
+        "Offenders": offenders,
+        "InstancesScanned": scanned,
+        "CollectMs": collect_ms,
+    }, separators=(",", ":")), flush=True)
+
 # ---------------- Public entry ----------------
 def run(session, webhook, region, env):
     logger.setLevel(getattr(logging, (env.get("LOG_LEVEL","INFO") or "INFO").upper(), logging.INFO))
 
     acct = get_acct_title(session)
-    ec2 = session.client("ec2", region_name=region)
-    cw  = session.client("cloudwatch", region_name=region)
+    ec2 = _client(session, "ec2", region)
+    cw  = _client(session, "cloudwatch", region)
 
     enable = env.get("ENABLE_EC2_UTILIZATION", "true").strip().lower() in ("1","true","t","yes","y")
     if not enable:
@@ -276,10 +390,14 @@ def run(session, webhook, region, env):
     minutes  = int(env.get("WINDOW_MIN", "10"))       # 10 for 10-min lookback
     period   = int(env.get("PERIOD", "60"))           # 60 for 1-min buckets
     rows_per_card = int(env.get("ROWS_PER_CARD","20"))
+    teams_concurrency = max(1, int(env.get("TEAMS_POST_CONCURRENCY","4")))  # keep low: webhooks are rate limited
     max_instances = int(env.get("MAX_INSTANCES","200"))
+    # never run more threads than the client has pooled connections
+    fetch_concurrency = max(1, min(int(env.get("FETCH_CONCURRENCY","16")), BOTO_CFG.max_pool_connections))
     only_running  = True
-    log_series    = env.get("LOG_1MIN_SERIES","true").strip().lower() in ("1","true","t","yes","y")
+    log_series    = env.get("LOG_1MIN_SERIES","false").strip().lower() in ("1","true","t","yes","y")
 
+    t0 = time.monotonic()
     end_utc   = datetime.now(timezone.utc)
     start_utc = end_utc - timedelta(minutes=minutes)
     buckets   = int(math.ceil((minutes * 60) / period))
@@ -301,62 +419,120 @@ def run(session, webhook, region, env):
 
     tag_key  = env.get("INSTANCE_TAG_KEY",  "").strip() or None
     tag_val  = env.get("INSTANCE_TAG_VALUE","").strip() or None
-
-    instances = _get_instances(ec2, tag_key, tag_val, only_running=only_running, max_instances=max_instances)
-    if not instances:
+    agent_key = env.get("CWAGENT_TAG_KEY",  "").strip() or None
+    agent_val = env.get("CWAGENT_TAG_VALUE","").strip() or None
+
+    instances = _get_instances(ec2, tag_key, tag_val, only_running=only_running, max_instances=max_instances,
+                               agent_tag=(agent_key, agent_val) if agent_key else None)
+
+    with ThreadPoolExecutor(max_workers=fetch_concurrency) as ex:
+        # One fleet-wide ListMetrics sweep per CWAgent metric instead of one per instance
+        sweeps = [ex.submit(_all_cwagent_dims, cw, m) for _, m in _CWAGENT_METRICS]
+        fetch = lambda batch: _get_metric_batch(cw, batch, start=start_utc, end=end_utc)
+
+        # Build one GetMetricData query per (instance, metric, dim set) as describe pages
+        # arrive, submitting each full batch right away
+        pending=[]; futures=[]; metas=[]; nq=0
+        stale_misses = {}  # metric_name -> [(iid, kind, qids)] to re-check after a re-sweep
+        resweeps = {}      # metric_name -> future of a forced re-sweep
+
+        def _add_queries(qids, kind, namespace, metric_name, dims_list):
+            nonlocal pending, nq
+            for dims in dims_list:
+                qid = f"m{nq}"; nq += 1
+                pending.append(_metric_query(qid, namespace, metric_name, dims, period))
+                qids[kind].append(qid)
+                if len(pending) >= MAX_METRIC_QUERIES:
+                    futures.append(ex.submit(fetch, pending)); pending = []
+
+        for iid, name, has_agent in instances:
+            if not metas:
+                for fut in sweeps: fut.result()  # dims are needed from here on
+            qids = {"cpu": [], "mem": [], "dsk": []}
+            _add_queries(qids, "cpu", "AWS/EC2", "CPUUtilization", [[{"Name":"InstanceId","Value":iid}]])
+            if has_agent:  # otherwise not expected to run CWAgent
+                for kind, metric_name in _CWAGENT_METRICS:
+                    dims, stale = _cwagent_dims(cw, metric_name, iid, expected=bool(agent_key))
+                    _add_queries(qids, kind, "CWAgent", metric_name, dims)
+                    if stale:
+                        stale_misses.setdefault(metric_name, []).append((iid, kind, qids))
+                        if metric_name not in resweeps and _claim_resweep(cw, metric_name):
+                            resweeps[metric_name] = ex.submit(_all_cwagent_dims, cw, metric_name, ttl=0)
+            metas.append((iid, name, qids))
+
+        # Misses that hinted at a stale sweep: re-check them against the fresh one
+        for metric_name, fut in resweeps.items():
+            fut.result()
+            for iid, kind, qids in stale_misses[metric_name]:
+                dims, _ = _cwagent_dims(cw, metric_name, iid)
+                _add_queries(qids, kind, "CWAgent", metric_name, dims)
+        if pending:
+            futures.append(ex.submit(fetch, pending))
+
+        data = {}
+        for fut in as_completed(futures):
+            data.update(fut.result())
+
+    if not metas:
+        _emit_emf(acct, 0, 0, int((time.monotonic() - t0) * 1000))
         logger.info("No running EC2 instances found for tag filter key=%r value=%r", tag_key, tag_val)
         # Do NOT send Teams/Email when nothing to report
         return {"ok": True, "instances": 0}
 
-    rows_all=[]
-    for inst in instances:
-        iid  = inst.get("InstanceId","-")
-        name = next((t["Value"] for t in inst.get("Tags",[]) if t.get("Key")=="Name"), "")
-        cpu  = _latest_stat_cw(cw, "AWS/EC2", "CPUUtilization", [{"Name":"InstanceId","Value":iid}],
-                               minutes=minutes, period=period, stat="Average", start=start_utc, end=end_utc)
-        meml = _find_cwagent_metric_dims(cw, "mem_used_percent",  iid)
-        mem  = _max_across_dims(cw, "mem_used_percent",  meml, minutes=minutes, period=period, start=start_utc, end=end_utc) if meml else None
-        dskl = _find_cwagent_metric_dims(cw, "disk_used_percent", iid)
-        dsk  = _max_across_dims(cw, "disk_used_percent", dskl, minutes=minutes, period=period, start=start_utc, end=end_utc) if dskl else None
-
-        if log_series:
-            cpu_series = _series_stat_cw(cw, "AWS/EC2", "CPUUtilization", [{"Name":"InstanceId","Value":iid}],
-                                         start=start_utc, end=end_utc, period=period, stat="Average")
-            mem_series = _series_max_cwagent(cw, "mem_used_percent",  meml, start=start_utc, end=end_utc, period=period) if meml else []
-            dsk_series = _series_max_cwagent(cw, "disk_used_percent", dskl, start=start_utc, end=end_utc, period=period) if dskl else []
+    def _fmt_series(s):
+        return ", ".join(f"{ts.strftime('%H:%M')}={float(v):.0f}%" for ts, v in s if v is not None)
 
-            def _fmt_series(s):
-                return ", ".join(f"{ts.strftime('%H:%M')}={float(v):.0f}%" for ts, v in s if v is not None)
+    # Keep ONLY offenders (WARN/ALERT on any metric); everything else is dropped as we go
+    offenders = []
+    limits = _limits(thr)
+    total_seen = len(metas)
+    for iid, name, qids in metas:
+        cpu_l = [data.pop(q, []) for q in qids["cpu"]]
+        mem_l = [data.pop(q, []) for q in qids["mem"]]
+        dsk_l = [data.pop(q, []) for q in qids["dsk"]]
+        cpu = _latest_across(cpu_l)
+        mem = _latest_across(mem_l)
+        dsk = _latest_across(dsk_l)
 
+        if log_series:
+            cpu_series = _series_max_across(cpu_l)
+            mem_series = _series_max_across(mem_l)
+            dsk_series = _series_max_across(dsk_l)
             logger.info("Instance %s (%s) 1-min CPU series [%d pts]: %s", iid, name or "-", len(cpu_series), _fmt_series(cpu_series) or "no datapoints")
             logger.info("Instance %s (%s) 1-min MEM series [%d pts]: %s", iid, name or "-", len(mem_series), _fmt_series(mem_series) or "no datapoints")
             logger.info("Instance %s (%s) 1-min DISK series[%d pts]: %s", iid, name or "-", len(dsk_series), _fmt_series(dsk_series) or "no datapoints")
 
-        rows_all.append((iid, name, cpu, mem, dsk, thr, region))
+        row = Row(iid, name, cpu, mem, dsk)
+        cells = _row_cells(row, limits)
+        if _row_overall_level(lvl for lvl, *_ in cells) in ("WARN", "ALERT"):
+            offenders.append((row, cells))
 
-    # Filter ONLY offenders (WARN/ALERT on any metric)
-    offenders = []
-    for row in rows_all:
-        iid, name, cpu, mem, dsk, th, region = row
-        level = _row_overall_level(cpu, mem, dsk, th)
-        if level in ("WARN", "ALERT"):
-            offenders.append(row)
+    _emit_emf(acct, len(offenders), total_seen, int((time.monotonic() - t0) * 1000))
 
     if not offenders:
         logger.info("No WARN/ALERT instances. Skipping Teams and Email.")
-        return {"ok": True, "instances": len(rows_all), "alerts_sent": 0}
-
-    # 1) Teams — only offenders
-    for card in _build_cards(acct, offenders, rows_per_card):
-        post_to_teams(webhook or os.environ.get("TEAMS_WEBHOOK",""), card)
+        return {"ok": True, "instances": total_seen, "alerts_sent": 0}
+
+    # 1) Teams — only offenders; cards are independent posts, so send a few at a time
+    cards = _build_cards(acct, offenders, rows_per_card, region=region)
+    url = webhook or env.get("TEAMS_WEBHOOK","")
+    teams_failed = 0
+    with ThreadPoolExecutor(max_workers=min(teams_concurrency, len(cards))) as ex:
+        for res in ex.map(lambda c: post_to_teams(url, c), cards):
+            if not res.get("ok"):
+                teams_failed += 1
+                logger.warning("Teams webhook post failed: HTTP %s", res.get("status"))
+    if teams_failed:
+        logger.error("Teams delivery failed for %d of %d card(s)", teams_failed, len(cards))
 
     # 2) Email — only offenders
     subject_default = f"EC2 Utilization Alerts - {len(offenders)} instance(s)"
-    text_body, html_body = _build_email(acct, offenders)
+    text_body, html_body = _build_email(acct, offenders, region=region)
     resp = _send_email_ses(session, region, env.get("MAIL_SUBJECT", subject_default), text_body, html_body, env)
     if resp:
         logger.info("Emailed EC2 utilization alerts. Offenders=%d", len(offenders))
     else:
         logger.info("Email skipped (missing MAIL_FROM/MAIL_TO or ENABLE_MAIL_REPORT=false)")
 
-    return {"ok": True, "instances": len(rows_all), "alerts_sent": len(offenders)}
+    return {"ok": teams_failed == 0, "instances": total_seen, "alerts_sent": len(offenders),
+            "teams_failed": teams_failed}
@@ -0,0 +1,9 @@
+
+from botocore.config import Config
+
+# Shared client config: pool sized above FETCH_CONCURRENCY so threads don't churn connections
+BOTO_CFG = Config(
+    max_pool_connections=32,
+    retries={"mode": "standard", "max_attempts": 3},
+    tcp_keepalive=True,
+)
@@ -1,13 +1,24 @@
 
 import boto3
 from botocore.exceptions import ClientError
+from shared.aws import BOTO_CFG
 
-def get_acct_title(session=None):
-    stss = (session or boto3.Session()).client("sts")
-    try:
-        aid = stss.get_caller_identity().get("Account","unknown")
-    except Exception:
-        aid = "unknown"
-    return f"AWS {aid}"
-
+_ACCT_TITLES = {}  # session -> label; an account never changes for the life of a session
 
+def get_acct_title(session=None, function_arn=None):
+    title = _ACCT_TITLES.get(session)
+    if title:
+        return title
+    # arn:aws:lambda:<region>:<account>:function:<name> carries the account; STS is the fallback
+    parts = (function_arn or "").split(":")
+    aid = parts[4] if len(parts) > 4 and parts[4] else None
+    if not aid:
+        stss = (session or boto3.Session()).client("sts", config=BOTO_CFG)
+        try:
+            aid = stss.get_caller_identity().get("Account")
+        except Exception:
+            aid = None
+    if not aid:
+        return "AWS unknown"  # not cached; retried next invocation
+    title = _ACCT_TITLES[session] = f"AWS {aid}"
+    return title
@@ -1,12 +1,15 @@
 
 import json
-from urllib.request import Request, urlopen
+import urllib3
+
+# Module-level pool: keeps the webhook TLS connection alive across cards and warm invocations
+_HTTP = urllib3.PoolManager(maxsize=8, retries=urllib3.Retry(3, backoff_factor=0.2))
 
 def post_to_teams(webhook_url: str, payload: dict):
-    body = json.dumps(payload).encode("utf-8")
-    req = Request(webhook_url, data=body, headers={"Content-Type": "application/json"})
-    with urlopen(req) as resp:
-        return {"ok": True, "status": resp.status}
+    # compact separators + raw UTF-8 (emoji stay 4 bytes instead of 12-byte \uXXXX pairs)
+    body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    resp = _HTTP.request("POST", webhook_url, body=body, headers={"Content-Type": "application/json"})
+    return {"ok": 200 <= resp.status < 300, "status": resp.status}
 
 def simple_card(title, message):
     return {